@@ -1,23 +1,64 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, session, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only, selectinload
+from sqlalchemy.pool import QueuePool
+from flask_bcrypt import Bcrypt
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
 from datetime import datetime
+from types import MappingProxyType
+from contextlib import contextmanager
+from itertools import groupby
+from operator import attrgetter
 import os
 from dotenv import load_dotenv
-import traceback
-import re
+import logging
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
+# コンパイル済みテンプレートをファイルに保存し、ワーカー間・再起動後も再利用
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 
 # データベース設定 - SQLiteのみ使用
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///season_calendar.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# リクエストごとにDBファイルを開き直さないよう接続をプールして再利用
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': QueuePool,
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_pre_ping': True,
+    'pool_recycle': 3600,
+    'connect_args': {'check_same_thread': False},
+}
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """SQLite接続ごとにWALモードと性能向けPRAGMAを設定"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+# パスワードハッシュ設定 - bcrypt (コスト12)
+app.config['BCRYPT_LOG_ROUNDS'] = 12
+bcrypt = Bcrypt(app)
+# bcryptが扱えるパスワードの最大バイト数
+BCRYPT_MAX_PASSWORD_BYTES = 72
+
 # Flask-Login設定
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -28,9 +69,9 @@ login_manager.login_message_category = 'info'
 @login_manager.user_loader
 def load_user(user_id):
     try:
-        return User.query.get(int(user_id))
-    except Exception as e:
-        print(f"User loader error: {e}")
+        return db.session.get(User, int(user_id))
+    except Exception:
+        logger.exception("User loader error")
         return None
 
 # パスワードバリデーション関数
@@ -42,27 +83,69 @@ def validate_password(password):
     if len(password) < 8:
         return False, "パスワードは8文字以上で入力してください。"
     
-    if not re.match(r'^[a-zA-Z0-9]+$', password):
+    if not (password.isascii() and password.isalnum()):
         return False, "パスワードは半角英数のみで入力してください。"
     
+    if len(password) > BCRYPT_MAX_PASSWORD_BYTES:
+        return False, f"パスワードは{BCRYPT_MAX_PASSWORD_BYTES}文字以下で入力してください。"
+    
     return True, ""
 
+def can_hash_with_bcrypt(password):
+    """bcryptでハッシュ化できる長さかどうか"""
+    return len(password.encode('utf-8')) <= BCRYPT_MAX_PASSWORD_BYTES
+
+# 未ログイン向けの静的ページ描画キャッシュ
+_static_page_cache = {}
+
+def render_static_page(template_name):
+    """ユーザー固有の内容がないページは描画済みHTMLを再利用"""
+    # フラッシュメッセージがある場合やデバッグ時は毎回描画
+    if app.debug or '_flashes' in session:
+        return render_template(template_name)
+    html = _static_page_cache.get(template_name)
+    if html is None:
+        html = _static_page_cache[template_name] = render_template(template_name)
+    return html
+
 # データベースモデル
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(120), nullable=False)
+    password_hash = db.Column(db.String(128), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    activities = db.relationship('SeasonActivity', backref='user', lazy=True)
+    # 暗黙の遅延読み込み(N+1)を防ぐため、必要な場合は selectinload で明示的に読み込む
+    activities = db.relationship('SeasonActivity', backref='user', lazy='raise')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if self.has_legacy_password_hash():
+            return check_password_hash(self.password_hash, password)
+        # bcryptは72バイトを超える入力を扱えない (登録時にも弾いている)
+        if not can_hash_with_bcrypt(password):
+            return False
+        return bcrypt.check_password_hash(self.password_hash, password)
+
+    def has_legacy_password_hash(self):
+        """以前のWerkzeug(PBKDF2)形式のハッシュかどうか"""
+        return not self.password_hash.startswith('$2')
+
+    @classmethod
+    def get_with_activities(cls, user_id):
+        """アクティビティも読み込む場合はこちらを使用 (IN句の追加クエリ1回で一括取得)"""
+        # load_user で読み込み済みのインスタンスにも options を適用するため populate_existing を指定
+        return db.session.get(cls, user_id,
+                              options=[selectinload(cls.activities)],
+                              populate_existing=True)
 
 class SeasonActivity(db.Model):
+    __table_args__ = (
+        db.Index('ix_activity_user_month', 'user_id', 'month'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     month = db.Column(db.Integer, nullable=False)
@@ -73,6 +156,17 @@ class SeasonActivity(db.Model):
     description = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+# 書き込み用トランザクション
+@contextmanager
+def transaction():
+    """ブロック内の変更を1回のコミットで確定し、失敗時はロールバック"""
+    try:
+        yield db.session
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
 # データベース初期化関数
 def init_db():
     """データベースとテーブルを初期化"""
@@ -80,29 +174,35 @@ def init_db():
         with app.app_context():
             db.create_all()
             print("データベーステーブルが作成されました")
-    except Exception as e:
-        print(f"データベース初期化エラー: {e}")
-        print(traceback.format_exc())
+    except Exception:
+        logger.exception("データベース初期化エラー")
 
-# アプリケーション起動時にデータベースを初期化
-init_db()
+# RUN_DB_INIT=1 の場合のみ起動時にデータベースを初期化
+# (本番では init_db.py がデプロイ時に1回だけ実行する)
+if os.environ.get('RUN_DB_INIT') == '1':
+    init_db()
 
 # 季節データ
-SEASON_DATA = {
-    1: {"name": "冬", "color": "#87CEEB", "activities": []},
-    2: {"name": "冬", "color": "#87CEEB", "activities": []},
-    3: {"name": "春", "color": "#90EE90", "activities": []},
-    4: {"name": "春", "color": "#90EE90", "activities": []},
-    5: {"name": "春", "color": "#90EE90", "activities": []},
-    6: {"name": "夏", "color": "#FFB6C1", "activities": []},
-    7: {"name": "夏", "color": "#FFB6C1", "activities": []},
-    8: {"name": "夏", "color": "#FFB6C1", "activities": []},
-    9: {"name": "秋", "color": "#DDA0DD", "activities": []},
-    10: {"name": "秋", "color": "#DDA0DD", "activities": []},
-    11: {"name": "秋", "color": "#DDA0DD", "activities": []},
-    12: {"name": "冬", "color": "#87CEEB", "activities": []}
+_SEASONS = {
+    "冬": MappingProxyType({"name": "冬", "color": "#87CEEB", "activities": ()}),
+    "春": MappingProxyType({"name": "春", "color": "#90EE90", "activities": ()}),
+    "夏": MappingProxyType({"name": "夏", "color": "#FFB6C1", "activities": ()}),
+    "秋": MappingProxyType({"name": "秋", "color": "#DDA0DD", "activities": ()}),
 }
 
+# シーン(誰と過ごすか)の一覧
+ACTIVITY_TYPES = ('一人', '友達', '家族', 'お年寄り')
+
+# 月番号(1〜12)で引く。0番目は未使用
+SEASON_DATA = (
+    None,
+    _SEASONS["冬"], _SEASONS["冬"],
+    _SEASONS["春"], _SEASONS["春"], _SEASONS["春"],
+    _SEASONS["夏"], _SEASONS["夏"], _SEASONS["夏"],
+    _SEASONS["秋"], _SEASONS["秋"], _SEASONS["秋"],
+    _SEASONS["冬"],
+)
+
 @app.errorhandler(500)
 def internal_error(error):
     """500エラーハンドラー"""
@@ -114,228 +214,250 @@ def not_found_error(error):
     """404エラーハンドラー"""
     return "ページが見つかりません。", 404
 
+def get_month_counts(user_id):
+    """各月のアイデア数を1回のクエリでまとめて取得"""
+    rows = db.session.query(SeasonActivity.month, db.func.count(SeasonActivity.id)) \
+        .filter_by(user_id=user_id) \
+        .group_by(SeasonActivity.month) \
+        .all()
+    month_counts = {month: 0 for month in range(1, 13)}
+    month_counts.update(dict(rows))
+    return month_counts
+
+# 月ごとの描画済みカレンダー (ユーザーに依存しない部分)
+_calendar_grid_cache = {}
+
+def render_calendar_grid(current_month):
+    """12ヶ月のカレンダーを描画。アイデア数はクライアント側で表示"""
+    html = None if app.debug else _calendar_grid_cache.get(current_month)
+    if html is None:
+        html = _calendar_grid_cache[current_month] = Markup(
+            render_template('calendar_grid.html',
+                            season_data=SEASON_DATA,
+                            current_month=current_month))
+    return html
+
 @app.route('/')
 def index():
     """ホームページ - 月別カレンダー表示"""
-    try:
-        if not current_user.is_authenticated:
-            return redirect(url_for('login'))
-        
-        current_month = datetime.now().month
-        
-        # 各月のアイデア数を取得
-        month_counts = {}
-        for month in range(1, 13):
-            count = SeasonActivity.query.filter_by(month=month, user_id=current_user.id).count()
-            month_counts[month] = count
-        
-        return render_template('index.html', 
-                             season_data=SEASON_DATA, 
-                             current_month=current_month,
-                             month_counts=month_counts)
-    except Exception as e:
-        print(f"Index error: {e}")
-        print(traceback.format_exc())
-        return "エラーが発生しました", 500
+    if not current_user.is_authenticated:
+        return redirect(url_for('login'))
+    
+    current_month = datetime.now().month
+    return render_template('index.html',
+                         calendar_grid=render_calendar_grid(current_month))
+
+@app.route('/api/month_counts')
+@login_required
+def month_counts():
+    """各月のアイデア数 (JSON)"""
+    return jsonify(get_month_counts(current_user.id))
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """ログインページ"""
-    try:
-        if current_user.is_authenticated:
-            return redirect(url_for('index'))
-        
-        if request.method == 'POST':
-            username = request.form['username']
-            password = request.form['password']
-            user = User.query.filter_by(username=username).first()
-            
-            if user and user.check_password(password):
-                login_user(user)
-                flash('ログインしました！', 'success')
-                return redirect(url_for('index'))
-            else:
-                flash('ユーザー名またはパスワードが正しくありません。', 'error')
+    if current_user.is_authenticated:
+        return redirect(url_for('index'))
+    
+    if request.method == 'POST':
+        username = request.form['username']
+        password = request.form['password']
+        user = User.query.filter_by(username=username).first()
         
-        return render_template('login.html')
-    except Exception as e:
-        print(f"Login error: {e}")
-        print(traceback.format_exc())
-        return "ログインエラーが発生しました", 500
+        if user and user.check_password(password):
+            # 旧形式のハッシュはログイン成功時にbcryptへ移行 (72バイト超は旧形式のまま)
+            if user.has_legacy_password_hash() and can_hash_with_bcrypt(password):
+                with transaction():
+                    user.set_password(password)
+            login_user(user)
+            flash('ログインしました！', 'success')
+            return redirect(url_for('index'))
+        else:
+            flash('ユーザー名またはパスワードが正しくありません。', 'error')
+    
+    return render_static_page('login.html')
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     """ユーザー登録ページ"""
-    try:
-        if current_user.is_authenticated:
-            return redirect(url_for('index'))
+    if current_user.is_authenticated:
+        return redirect(url_for('index'))
+    
+    if request.method == 'POST':
+        username = request.form['username']
+        email = request.form['email']
+        password = request.form['password']
+        confirm_password = request.form['confirm_password']
         
-        if request.method == 'POST':
-            username = request.form['username']
-            email = request.form['email']
-            password = request.form['password']
-            confirm_password = request.form['confirm_password']
-            
-            # バリデーション
-            if User.query.filter_by(username=username).first():
+        # バリデーション (ユーザー名・メールアドレスの重複を1回のクエリで確認、ユーザー名を優先して報告)
+        existing = db.session.query(User.username, User.email) \
+            .filter(db.or_(User.username == username, User.email == email)) \
+            .order_by((User.username == username).desc()) \
+            .first()
+        if existing:
+            if existing.username == username:
                 flash('このユーザー名は既に使用されています。', 'error')
-                return render_template('register.html')
-            
-            if User.query.filter_by(email=email).first():
+            else:
                 flash('このメールアドレスは既に使用されています。', 'error')
-                return render_template('register.html')
-            
-            # パスワードバリデーション
-            is_valid, error_message = validate_password(password)
-            if not is_valid:
-                flash(error_message, 'error')
-                return render_template('register.html')
-            
-            if password != confirm_password:
-                flash('パスワードが一致しません。', 'error')
-                return render_template('register.html')
-            
-            # ユーザー作成
-            user = User(username=username, email=email)
-            user.set_password(password)
-            db.session.add(user)
-            db.session.commit()
-            
-            # 自動ログイン
-            login_user(user)
-            flash(f'{username}さん、ようこそ！アカウントが作成されました。', 'success')
-            return redirect(url_for('index'))
+            return render_template('register.html')
         
-        return render_template('register.html')
-    except Exception as e:
-        print(f"Register error: {e}")
-        print(traceback.format_exc())
-        return "登録エラーが発生しました", 500
+        # パスワードバリデーション
+        is_valid, error_message = validate_password(password)
+        if not is_valid:
+            flash(error_message, 'error')
+            return render_template('register.html')
+        
+        if password != confirm_password:
+            flash('パスワードが一致しません。', 'error')
+            return render_template('register.html')
+        
+        # ユーザー作成
+        user = User(username=username, email=email)
+        user.set_password(password)
+        try:
+            with transaction():
+                db.session.add(user)
+        except IntegrityError:
+            # 確認後に同時登録された場合
+            flash('このユーザー名またはメールアドレスは既に使用されています。', 'error')
+            return render_template('register.html')
+        
+        # 自動ログイン
+        login_user(user)
+        flash(f'{username}さん、ようこそ！アカウントが作成されました。', 'success')
+        return redirect(url_for('index'))
+    
+    return render_static_page('register.html')
 
 @app.route('/logout')
 @login_required
 def logout():
     """ログアウト"""
-    try:
-        logout_user()
-        flash('ログアウトしました。', 'info')
-        return redirect(url_for('login'))
-    except Exception as e:
-        print(f"Logout error: {e}")
-        return redirect(url_for('login'))
+    logout_user()
+    flash('ログアウトしました。', 'info')
+    return redirect(url_for('login'))
 
 @app.route('/month/<int:month>')
 @login_required
 def month_detail(month):
     """月別詳細ページ"""
-    try:
-        if month < 1 or month > 12:
-            return redirect(url_for('index'))
-        
-        # 現在のユーザーのアクティビティのみ取得
-        activities = SeasonActivity.query.filter_by(month=month, user_id=current_user.id).all()
-        season_info = SEASON_DATA[month]
-        
-        # アクティビティをカテゴリ別に整理
-        categorized_activities = {
-            '一人': [],
-            '友達': [],
-            '家族': [],
-            'お年寄り': []
-        }
-        
-        for activity in activities:
-            if activity.activity_type in categorized_activities:
-                categorized_activities[activity.activity_type].append(activity)
-        
-        return render_template('month_detail.html', 
-                             month=month, 
-                             season_info=season_info,
-                             activities=categorized_activities)
-    except Exception as e:
-        print(f"Month detail error: {e}")
-        print(traceback.format_exc())
-        return "エラーが発生しました", 500
+    if month < 1 or month > 12:
+        return redirect(url_for('index'))
+    
+    # 現在のユーザーのアクティビティのみ、表示に使う列だけをシーン順に取得
+    activities = SeasonActivity.query.filter_by(month=month, user_id=current_user.id) \
+        .with_entities(SeasonActivity.id,
+                       SeasonActivity.activity_type,
+                       SeasonActivity.category,
+                       SeasonActivity.title,
+                       SeasonActivity.description,
+                       SeasonActivity.created_at) \
+        .order_by(SeasonActivity.activity_type, SeasonActivity.id) \
+        .all()
+    season_info = SEASON_DATA[month]
+    
+    # アクティビティをカテゴリ別に整理
+    categorized_activities = {activity_type: [] for activity_type in ACTIVITY_TYPES}
+    for activity_type, group in groupby(activities, key=attrgetter('activity_type')):
+        if activity_type in categorized_activities:
+            categorized_activities[activity_type] = list(group)
+    
+    return render_template('month_detail.html', 
+                         month=month, 
+                         season_info=season_info,
+                         activities=categorized_activities)
 
 @app.route('/add_activity', methods=['GET', 'POST'])
 @login_required
 def add_activity():
     """アクティビティ追加"""
-    try:
-        if request.method == 'POST':
-            month = int(request.form['month'])
-            activity_type = request.form['activity_type']
-            category = request.form['category']
-            title = request.form['title']
-            description = request.form['description']
-            
-            new_activity = SeasonActivity(
-                user_id=current_user.id,
-                month=month,
-                season=SEASON_DATA[month]['name'],
-                activity_type=activity_type,
-                category=category,
-                title=title,
-                description=description
-            )
-            
+    if request.method == 'POST':
+        month = int(request.form['month'])
+        if month < 1 or month > 12:
+            abort(400)
+        activity_type = request.form['activity_type']
+        category = request.form['category']
+        title = request.form['title']
+        description = request.form['description']
+        
+        new_activity = SeasonActivity(
+            user_id=current_user.id,
+            month=month,
+            season=SEASON_DATA[month]['name'],
+            activity_type=activity_type,
+            category=category,
+            title=title,
+            description=description
+        )
+        
+        with transaction():
             db.session.add(new_activity)
-            db.session.commit()
-            
-            flash('アイデアが追加されました！', 'success')
-            return redirect(url_for('month_detail', month=month))
         
-        return render_template('add_activity.html', season_data=SEASON_DATA)
-    except Exception as e:
-        print(f"Add activity error: {e}")
-        print(traceback.format_exc())
-        return "エラーが発生しました", 500
+        flash('アイデアが追加されました！', 'success')
+        return redirect(url_for('month_detail', month=month))
+    
+    return render_template('add_activity.html', season_data=SEASON_DATA)
 
 @app.route('/edit_activity/<int:activity_id>', methods=['GET', 'POST'])
 @login_required
 def edit_activity(activity_id):
     """アクティビティ編集"""
-    try:
-        # 自分のアクティビティのみ編集可能
-        activity = SeasonActivity.query.filter_by(id=activity_id, user_id=current_user.id).first_or_404()
+    # 自分のアクティビティのみ編集可能
+    if request.method == 'POST':
+        month = int(request.form['month'])
+        if month < 1 or month > 12:
+            abort(400)
         
-        if request.method == 'POST':
-            activity.month = int(request.form['month'])
-            activity.activity_type = request.form['activity_type']
-            activity.category = request.form['category']
-            activity.title = request.form['title']
-            activity.description = request.form['description']
-            activity.season = SEASON_DATA[activity.month]['name']
-            
-            db.session.commit()
-            
-            flash('アイデアが更新されました！', 'success')
-            return redirect(url_for('month_detail', month=activity.month))
+        # 事前のSELECTをせず、1回のUPDATEで更新
+        with transaction():
+            updated = db.session.execute(
+                db.update(SeasonActivity)
+                .where(SeasonActivity.id == activity_id, SeasonActivity.user_id == current_user.id)
+                .values(month=month,
+                        season=SEASON_DATA[month]['name'],
+                        activity_type=request.form['activity_type'],
+                        category=request.form['category'],
+                        title=request.form['title'],
+                        description=request.form['description'])
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not updated:
+                abort(404)
         
-        return render_template('edit_activity.html', 
-                             activity=activity, 
-                             season_data=SEASON_DATA)
-    except Exception as e:
-        print(f"Edit activity error: {e}")
-        print(traceback.format_exc())
-        return "エラーが発生しました", 500
+        flash('アイデアが更新されました！', 'success')
+        return redirect(url_for('month_detail', month=month))
+    
+    # フォーム表示に使う列のみ取得
+    activity = SeasonActivity.query \
+        .options(load_only(SeasonActivity.month,
+                           SeasonActivity.activity_type,
+                           SeasonActivity.category,
+                           SeasonActivity.title,
+                           SeasonActivity.description)) \
+        .filter_by(id=activity_id, user_id=current_user.id) \
+        .first_or_404()
+    
+    return render_template('edit_activity.html', 
+                         activity=activity, 
+                         season_data=SEASON_DATA)
 
 @app.route('/delete_activity/<int:activity_id>')
 @login_required
 def delete_activity(activity_id):
     """アクティビティ削除"""
-    try:
-        # 自分のアクティビティのみ削除可能
-        activity = SeasonActivity.query.filter_by(id=activity_id, user_id=current_user.id).first_or_404()
-        month = activity.month
-        db.session.delete(activity)
-        db.session.commit()
-        flash('アイデアが削除されました', 'info')
-        return redirect(url_for('month_detail', month=month))
-    except Exception as e:
-        print(f"Delete activity error: {e}")
-        print(traceback.format_exc())
-        return "エラーが発生しました", 500
+    # 自分のアクティビティのみ削除可能
+    # 削除と月の取得を1回のDELETE ... RETURNINGで行う
+    with transaction():
+        month = db.session.execute(
+            db.delete(SeasonActivity)
+            .where(SeasonActivity.id == activity_id, SeasonActivity.user_id == current_user.id)
+            .returning(SeasonActivity.month)
+        ).scalar()
+        if month is None:
+            abort(404)
+    flash('アイデアが削除されました', 'info')
+    return redirect(url_for('month_detail', month=month))
 
 if __name__ == '__main__':
+    init_db()
     app.run(debug=True) 
\ No newline at end of file
@@ -10,8 +10,19 @@ def init_database():
     """データベースとテーブルを初期化"""
     with app.app_context():
         db.create_all()
+        # 既存テーブルには create_all でインデックスが追加されないため個別に作成
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=db.engine, checkfirst=True)
         print("✅ データベーステーブルが正常に作成されました")
         print("📊 テーブル: season_activity")
 
+def warm_template_cache():
+    """全テンプレートを事前にコンパイルしてバイトコードキャッシュに保存"""
+    for template_name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template_name)
+    print("✅ テンプレートのキャッシュを作成しました")
+
 if __name__ == "__main__":
-    init_database() 
\ No newline at end of file
+    init_database()
+    warm_template_cache() 
\ No newline at end of file